@@ -1,114 +1,170 @@
 import asyncio
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from glob import escape, glob
 
 import click
+import librosa
 import numpy as np
 import pandas as pd
-from jiwer import cer, wer
-from joblib import Parallel, delayed
-from pydub import AudioSegment
+import soundfile as sf
+from jiwer import process_characters, process_words
 from pytriton.client import AsyncioModelClient
 from tqdm import tqdm
 
 
-async def get_texts_from_audio_by_asr(triton_address, triton_port, dataset_dir, input_batch):
-    results = {}
-    pending_responces = {}
+def read_audio(input_path, sample_rate=16000):
+    audio, original_sample_rate = sf.read(input_path, dtype="int16")
+    # Samples are widened to float64 only once, keeping the int16 scale the ASR model expects
+    audio = audio.mean(axis=1) if audio.ndim > 1 else audio.astype(np.float64)
 
-    client = AsyncioModelClient(f"{triton_address}:{triton_port}", "ensemble_english_stt", inference_timeout_s=600)
+    if original_sample_rate != sample_rate:
+        audio = librosa.resample(audio, orig_sr=original_sample_rate, target_sr=sample_rate)
 
-    async with asyncio.TaskGroup() as tg:
-        for input_file in input_batch:
-            input_path = os.path.join(dataset_dir, input_file)
-            txt_path = input_path.replace("/wavs", "/asr_recognized_texts").replace(".wav", ".txt")
+    return audio
 
-            if os.path.exists(txt_path):
-                with open(txt_path, "r", encoding="UTF-8") as text_file:
-                    text = text_file.read()
-                results[input_file] = text
-            else:
-                audio = AudioSegment.from_wav(input_path).set_channels(1)
-                audio = audio.set_frame_rate(16000)
-                audio_data = np.array(audio.get_array_of_samples(), dtype=np.float64)
 
-                result = tg.create_task(client.infer_sample(audio_signal=audio_data))
-                pending_responces[input_file] = result  # .tolist()[0]
+def read_text(txt_path):
+    with open(txt_path, "r", encoding="UTF-8") as text_file:
+        return text_file.read()
 
-    await client.close()
 
-    for input_file, responce in pending_responces.items():
-        input_path = os.path.join(dataset_dir, input_file)
-        txt_path = input_path.replace("/wavs", "/asr_recognized_texts").replace(".wav", ".txt")
+def write_text(txt_path, text):
+    with open(txt_path, "w", encoding="UTF-8") as text_file:
+        text_file.write(text)
 
-        text = responce.result()["decoded_texts"].decode("UTF-8")
 
-        os.makedirs(os.path.dirname(txt_path), exist_ok=True)
-        with open(txt_path, "w", encoding="UTF-8") as text_file:
-            text_file.write(text)
+async def recognize_audio(client, io_executor, input_path, txt_path):
+    loop = asyncio.get_running_loop()
 
-        results[input_file] = text
+    # Decoding and writing run in worker threads, so other requests keep being sent meanwhile
+    audio_data = await loop.run_in_executor(io_executor, read_audio, input_path)
+    responce = await client.infer_sample(audio_signal=audio_data)
 
-    return results
+    text = responce["decoded_texts"].decode("UTF-8")
+    await loop.run_in_executor(io_executor, write_text, txt_path, text)
 
+    return text
 
-def process_audios(input_batch, dataset_dir, triton_address, triton_port, tqdm_bar):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
 
-    recognized_texts = loop.run_until_complete(
-        get_texts_from_audio_by_asr(
-            input_batch=input_batch,
-            dataset_dir=dataset_dir,
-            triton_address=triton_address,
-            triton_port=triton_port,
-        )
-    )
+async def get_texts_from_audio_by_asr(
+    triton_address, triton_port, triton_protocol, dataset_dir, input_files, existing_texts, concurrency, tqdm_bar
+):
+    recognized_texts = {}
+
+    input_paths = [os.path.join(dataset_dir, input_file) for input_file in input_files]
+    txt_paths = [get_txt_path(dataset_dir, input_file) for input_file in input_files]
+
+    # Output directories are created once here instead of once for every recognized file
+    for txt_dir in {os.path.dirname(txt_path) for txt_path in txt_paths if txt_path not in existing_texts}:
+        os.makedirs(txt_dir, exist_ok=True)
+
+    # Workers take the next sample from a shared iterator, so only `concurrency` tasks exist at any time
+    samples = zip(input_files, input_paths, txt_paths)
 
-    tqdm_bar.update(len(input_batch))
+    async def worker(client, io_executor):
+        for input_file, input_path, txt_path in samples:
+            if txt_path in existing_texts:
+                # Already recognized texts are read in a worker thread instead of blocking the event loop
+                recognized_texts[input_file] = await asyncio.to_thread(read_text, txt_path)
+            else:
+                recognized_texts[input_file] = await recognize_audio(client, io_executor, input_path, txt_path)
+
+            tqdm_bar.update(1)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as io_executor:
+        # A single client is shared by every request, so the connection is set up only once per run
+        async with AsyncioModelClient(
+            f"{triton_protocol}://{triton_address}:{triton_port}", "ensemble_english_stt", inference_timeout_s=600
+        ) as client:
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(concurrency):
+                    tg.create_task(worker(client, io_executor))
 
     return recognized_texts
 
 
+def get_txt_path(dataset_dir, input_file):
+    # Only the part inside the dataset is renamed, and the path is normalized to match the glob results
+    txt_file = os.path.normpath(os.path.join("/", input_file))
+    txt_file = txt_file.replace("/wavs", "/asr_recognized_texts").replace(".wav", ".txt")
+    return os.path.normpath(os.path.join(dataset_dir, txt_file.lstrip("/")))
+
+
+def get_error_rates(references, hypotheses, process_fn=process_words):
+    if not references:
+        return []
+
+    # Aligns the whole column in a single jiwer call and takes the per-sample rate from each alignment
+    output = process_fn(references, hypotheses)
+
+    error_rates = []
+    for reference, alignment in zip(output.references, output.alignments):
+        errors = sum(
+            max(chunk.ref_end_idx - chunk.ref_start_idx, chunk.hyp_end_idx - chunk.hyp_start_idx)
+            for chunk in alignment
+            if chunk.type != "equal"
+        )
+        error_rates.append(errors / len(reference))
+
+    return error_rates
+
+
+def get_existing_recognized_texts(dataset_dir):
+    # One directory walk instead of a stat call for every processed file
+    txt_paths = glob(os.path.join(escape(dataset_dir), "**", "asr_recognized_texts", "**", "*.txt"), recursive=True)
+    return {os.path.normpath(txt_path) for txt_path in txt_paths}
+
+
 @click.command()
 @click.option("--dataset_path", help="Path to the dataset containing audio files.")
 @click.option("--wer_threshold", type=float, default=0.5, help="WER threshold.")
 @click.option("--cer_threshold", type=float, default=0.5, help="CER threshold.")
 @click.option("--triton_address", default="localhost", help="Address of the Triton Inference Server.")
-@click.option("--triton_port", type=int, default=8000, help="Port of the Triton Inference Server.")
-@click.option("--batch_size", type=int, default=10, help="Batch size for processing audio files.")
+@click.option("--triton_port", type=int, default=8001, help="Port of the Triton Inference Server.")
 @click.option(
-    "--n_jobs", type=int, default=-1, help="Number of parallel jobs to use while processing. -1 means to use all cores."
+    "--triton_protocol",
+    type=click.Choice(["grpc", "http"]),
+    default="grpc",
+    help="Protocol used to communicate with the Triton Inference Server.",
 )
-def process_dataset(dataset_path, wer_threshold, cer_threshold, triton_address, triton_port, batch_size, n_jobs):
+@click.option(
+    "--concurrency",
+    type=int,
+    default=32,
+    help="Maximum number of requests sent to the Triton Inference Server at once.",
+)
+def process_dataset(
+    dataset_path, wer_threshold, cer_threshold, triton_address, triton_port, triton_protocol, concurrency
+):
     metadata_path = os.path.join(dataset_path, "metadata.csv")
-    metadata_df = pd.read_csv(metadata_path, sep="|")
-
-    assert "path_to_wav" in metadata_df.columns
-    assert "text" in metadata_df.columns
-    assert "speaker_id" in metadata_df.columns
+    metadata_df = pd.read_csv(metadata_path, sep="|", usecols=["path_to_wav", "text", "speaker_id"], engine="pyarrow")
 
     if not os.path.exists(os.path.join(dataset_path, "metadata_before_ASR.csv")):
-        metadata_df.to_csv(os.path.join(dataset_path, "metadata_before_ASR.csv"), sep="|", index=False)
+        shutil.copyfile(metadata_path, os.path.join(dataset_path, "metadata_before_ASR.csv"))
 
     files = metadata_df["path_to_wav"].values
+    existing_texts = get_existing_recognized_texts(dataset_path)
     status_bar = tqdm(files, total=len(files), desc="Processing audio files")
 
-    batches = [files[i : min(i + batch_size, len(files))] for i in range(0, len(files), batch_size)]
-
-    list_of_recognized_texts = Parallel(n_jobs=n_jobs, require="sharedmem")(
-        delayed(process_audios)(
-            input_batch=batch,
-            dataset_dir=dataset_path,
-            tqdm_bar=status_bar,
+    recognized_texts = asyncio.run(
+        get_texts_from_audio_by_asr(
             triton_address=triton_address,
             triton_port=triton_port,
+            triton_protocol=triton_protocol,
+            dataset_dir=dataset_path,
+            input_files=files,
+            existing_texts=existing_texts,
+            concurrency=concurrency,
+            tqdm_bar=status_bar,
         )
-        for batch in batches
     )
 
-    recognized_texts = {path: text for batch in list_of_recognized_texts for path, text in batch.items()}
-
-    metadata_df["recognized_text"] = metadata_df["path_to_wav"].map(recognized_texts)
+    recognized_texts_df = pd.DataFrame(
+        {"path_to_wav": list(recognized_texts.keys()), "recognized_text": list(recognized_texts.values())}
+    )
+    metadata_df = metadata_df.merge(recognized_texts_df, on="path_to_wav", how="left")
 
     recognized_text_empty_mask = metadata_df["recognized_text"].isnull()
     print(
@@ -120,8 +176,7 @@ def process_dataset(dataset_path, wer_threshold, cer_threshold, triton_address,
     print(f"Found {sum(original_text_empty_mask)} samples for which there are no texts found. Deleting from dataset.")
     metadata_df = metadata_df[~original_text_empty_mask]
 
-    metadata_df["wer"] = metadata_df.apply(lambda row: wer(row["text"], row["recognized_text"]), axis=1)
-    metadata_df["cer"] = metadata_df.apply(lambda row: cer(row["text"], row["recognized_text"]), axis=1)
+    metadata_df["wer"] = get_error_rates(metadata_df["text"].tolist(), metadata_df["recognized_text"].tolist())
 
     wer_mask = metadata_df["wer"] >= wer_threshold
     print(
@@ -129,6 +184,11 @@ def process_dataset(dataset_path, wer_threshold, cer_threshold, triton_address,
     )
     metadata_df = metadata_df[~wer_mask]
 
+    # CER is only computed for samples that passed the WER threshold
+    metadata_df["cer"] = get_error_rates(
+        metadata_df["text"].tolist(), metadata_df["recognized_text"].tolist(), process_fn=process_characters
+    )
+
     cer_mask = metadata_df["cer"] >= cer_threshold
     print(
         f"Found {sum(cer_mask)} samples for which CER threshold of {cer_threshold:.2f} exceeded. Deleting from dataset."
@@ -1,60 +1,55 @@
 import asyncio
 import os
-from random import randint
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from glob import escape, glob
 
 import click
 import numpy as np
 import pandas as pd
 import soundfile as sf
-from joblib import Parallel, delayed
-from pydub import AudioSegment
 from pytriton.client import AsyncioModelClient
 from tqdm import tqdm
 
 
-async def send_data_to_enhancer(
-    input_batch,
-    dataset_dir,
-    save_dir,
-    triton_address,
-    triton_port,
-    model_name,
-    chunk_duration=30.0,
-    chunk_overlap=1.0,
-):
-    await asyncio.sleep(randint(10, 90) / 100)  # To prevent processes beeing intersected
-    results = {}
-    client = AsyncioModelClient(f"{triton_address}:{triton_port}", model_name, inference_timeout_s=600)
+def read_audio(input_path):
+    audio_data, sample_rate = sf.read(input_path, dtype="float32")
 
-    async with asyncio.TaskGroup() as tg:
-        for file in input_batch:
-            input_path = os.path.join(dataset_dir, file)
-            output_path = os.path.join(save_dir, file)
+    if audio_data.ndim > 1:
+        audio_data = audio_data.mean(axis=1)
 
-            if os.path.exists(output_path):
-                continue
+    return audio_data, sample_rate
 
-            audio = AudioSegment.from_wav(input_path)
-            audio = audio.set_channels(1)
 
-            audio_data = np.array(audio.get_array_of_samples(), dtype=np.float32)
+def write_audio(output_path, audio_data):
+    audio_data = np.ascontiguousarray(audio_data, dtype=np.float32)
+    sf.write(output_path, audio_data, 44100, subtype="PCM_16")
 
-            results[output_path] = tg.create_task(
-                client.infer_sample(
-                    INPUT_AUDIO=audio_data,
-                    SAMPLE_RATE=np.asarray([audio.frame_rate]),
-                    CHUNK_DURATION_S=np.asarray([chunk_duration], dtype=np.float32),
-                    CHUNK_OVERLAP_S=np.asarray([chunk_overlap], dtype=np.float32),
-                )
-            )
 
-    await client.close()
+@lru_cache
+def get_sample_rate_input(sample_rate):
+    # Datasets usually have a handful of sample rates, so the tensor is built once per rate
+    return np.asarray([sample_rate])
 
-    return results
 
+async def enhance_audio(client, io_executor, input_path, output_path, chunk_duration_s, chunk_overlap_s):
+    loop = asyncio.get_running_loop()
 
-def process_audio_file(
-    input_batch,
+    audio_data, sample_rate = await loop.run_in_executor(io_executor, read_audio, input_path)
+    output = await client.infer_sample(
+        INPUT_AUDIO=audio_data,
+        SAMPLE_RATE=get_sample_rate_input(sample_rate),
+        CHUNK_DURATION_S=chunk_duration_s,
+        CHUNK_OVERLAP_S=chunk_overlap_s,
+    )
+
+    # Writing off the event loop lets the replies of other in-flight requests be received meanwhile
+    await loop.run_in_executor(io_executor, write_audio, output_path, output["OUTPUT_AUDIO"])
+
+
+async def send_data_to_enhancer(
+    input_files,
     dataset_dir,
     save_dir,
     tqdm_bar: tqdm,
@@ -62,30 +57,37 @@ def process_audio_file(
     chunk_overlap=1.0,
     model_name="enhancer_ensemble",
     triton_address="localhost",
-    triton_port=8000,
+    triton_port=8001,
+    triton_protocol="grpc",
+    concurrency=32,
 ):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    results = loop.run_until_complete(
-        send_data_to_enhancer(
-            input_batch,
-            dataset_dir,
-            save_dir,
-            triton_address,
-            triton_port,
-            model_name,
-            chunk_duration,
-            chunk_overlap,
-        )
-    )
+    # These inputs are identical for every file, so they are allocated once per run
+    chunk_duration_s = np.asarray([chunk_duration], dtype=np.float32)
+    chunk_overlap_s = np.asarray([chunk_overlap], dtype=np.float32)
+
+    input_paths = [os.path.join(dataset_dir, file) for file in input_files]
+    output_paths = [os.path.join(save_dir, file) for file in input_files]
+
+    # Output directories are created once here instead of once for every enhanced file
+    for output_dir in {os.path.dirname(output_path) for output_path in output_paths}:
+        os.makedirs(output_dir, exist_ok=True)
 
-    for output_path, output in results.items():
-        if not os.path.exists(os.path.dirname(output_path)):
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    # Workers take the next file from a shared iterator, so only `concurrency` tasks exist at any time
+    samples = zip(input_paths, output_paths)
 
-        sf.write(output_path, output.result()["OUTPUT_AUDIO"], 44100)
+    async def worker(client, io_executor):
+        for input_path, output_path in samples:
+            await enhance_audio(client, io_executor, input_path, output_path, chunk_duration_s, chunk_overlap_s)
+            tqdm_bar.update(1)
 
-    tqdm_bar.update(len(input_batch))
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as io_executor:
+        # A single client is shared by every request, so the connection is set up only once per run
+        async with AsyncioModelClient(
+            f"{triton_protocol}://{triton_address}:{triton_port}", model_name, inference_timeout_s=600
+        ) as client:
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(concurrency):
+                    tg.create_task(worker(client, io_executor))
 
 
 @click.command()
@@ -108,21 +110,21 @@ def process_audio_file(
 @click.option(
     "--model_name", default="enhancer_ensemble", show_default=True, help="The name of Triton Inference Server model."
 )
+@click.option("--triton_address", help="The Triton Inference Server address")
+@click.option("--triton_port", type=int, help="The Triton Inference Server port")
 @click.option(
-    "--batch_size",
-    type=int,
-    default=10,
+    "--triton_protocol",
+    type=click.Choice(["grpc", "http"]),
+    default="grpc",
     show_default=True,
-    help="The size of the batch of async tasks every job will process",
+    help="The protocol used to communicate with the Triton Inference Server.",
 )
-@click.option("--triton_address", help="The Triton Inference Server address")
-@click.option("--triton_port", type=int, help="The Triton Inference Server port")
 @click.option(
-    "--n_jobs",
+    "--concurrency",
     type=int,
-    default=-1,
+    default=32,
     show_default=True,
-    help="Number of parallel jobs. If -1 specified, use all available CPU cores.",
+    help="Maximum number of requests sent to the Triton Inference Server at once.",
 )
 def process_dataset(
     dataset_path,
@@ -130,25 +132,30 @@ def process_dataset(
     chunk_duration=30.0,
     chunk_overlap=1.0,
     model_name="enhancer_ensemble",
-    batch_size=10,
     triton_address="localhost",
-    triton_port=8000,
-    n_jobs=-1,
+    triton_port=8001,
+    triton_protocol="grpc",
+    concurrency=32,
 ):
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    metadata_df = pd.read_csv(os.path.join(dataset_path, "metadata.csv"), sep="|")
+    metadata_df = pd.read_csv(
+        os.path.join(dataset_path, "metadata.csv"), sep="|", usecols=["path_to_wav"], engine="pyarrow"
+    )
 
     files = metadata_df["path_to_wav"].sample(frac=1).values
 
-    status_bar = tqdm(files, total=len(files), desc="Processing audio files")
+    # Already enhanced files are skipped using a single directory walk instead of a stat call per file
+    existing_files = glob(os.path.join(escape(output_path), "**", "*.wav"), recursive=True)
+    existing_files = {os.path.normpath(existing_file) for existing_file in existing_files}
+    files = [file for file in files if os.path.normpath(os.path.join(output_path, file)) not in existing_files]
 
-    batches = [files[i : min(i + batch_size, len(files))] for i in range(0, len(files), batch_size)]
+    status_bar = tqdm(files, total=len(files), desc="Processing audio files")
 
-    Parallel(n_jobs=n_jobs, require="sharedmem")(
-        delayed(process_audio_file)(
-            input_batch=batch,
+    asyncio.run(
+        send_data_to_enhancer(
+            input_files=files,
             dataset_dir=dataset_path,
             save_dir=output_path,
             tqdm_bar=status_bar,
@@ -157,11 +164,12 @@ def process_dataset(
             model_name=model_name,
             triton_address=triton_address,
             triton_port=triton_port,
+            triton_protocol=triton_protocol,
+            concurrency=concurrency,
         )
-        for batch in batches
     )
 
-    metadata_df.to_csv(os.path.join(output_path, "metadata.csv"), sep="|", index=False)
+    shutil.copyfile(os.path.join(dataset_path, "metadata.csv"), os.path.join(output_path, "metadata.csv"))
 
 
 if __name__ == "__main__":
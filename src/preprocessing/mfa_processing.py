@@ -1,13 +1,20 @@
 import os
 import re
-from typing import List
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
 import click
 import pandas as pd
 from joblib import Parallel, cpu_count, delayed
-from textgrid import TextGrid
 from tqdm import tqdm
 
+MULTIPLE_PUNCTUATION_REGEX = re.compile(r"[,.]{2,}")
+MULTIPLE_SPACES_REGEX = re.compile(r"\s{2,}")
+TEXT_GRID_INTERVAL_REGEX = re.compile(r'xmin = (\S+)\s+xmax = (\S+)\s+text = "((?:[^"]|"")*)"')
+
 
 @click.command("main", context_settings={"show_default": True})
 @click.argument("input_path", type=click.Path(exists=True))
@@ -30,8 +37,7 @@ from tqdm import tqdm
     default=0.3,
 )
 def main(input_path: str, n_jobs: int, comma_duration: float, period_duration: float) -> None:
-    if n_jobs == -1:
-        n_jobs = cpu_count()
+    n_jobs = normalize_n_jobs(n_jobs)
 
     metadata_path = os.path.join(input_path, "metadata.csv")
     metadata_df = pd.read_csv(metadata_path, sep="|")
@@ -39,36 +45,58 @@ def main(input_path: str, n_jobs: int, comma_duration: float, period_duration: f
     if not os.path.exists(os.path.join(input_path, "metadata_before_MFA.csv")):
         metadata_df.to_csv(os.path.join(input_path, "metadata_before_MFA.csv"), sep="|", index=False)
 
-    os.system("mfa model download acoustic english_us_arpa")
-    os.system("mfa model download dictionary english_us_arpa")
+    subprocess.run(["mfa", "model", "download", "acoustic", "english_us_arpa"], check=False)
+    subprocess.run(["mfa", "model", "download", "dictionary", "english_us_arpa"], check=False)
 
-    directories_to_process = get_list_of_directories(metadata_df["path_to_wav"])
+    # Rows are grouped by their directory once instead of scanning all paths for every directory
+    directories_to_process = metadata_df.groupby(get_directories(metadata_df["path_to_wav"]), sort=False).groups
 
     progress_bar = tqdm(total=len(metadata_df))
-    for directory in directories_to_process:
-        processing_files = metadata_df[metadata_df["path_to_wav"].str.startswith(directory)]
-        save_texts_to_txt(dataset_path=input_path, metadata=processing_files, n_jobs=n_jobs)
-
-        wavs_directory_path = os.path.join(input_path, directory)
-        txt_directory_path = wavs_directory_path.replace("wavs", "txts")
-        text_grid_directory_path = wavs_directory_path.replace("wavs", "text_grids")
-
-        os.system(
-            f"mfa align --clean --single_speaker --include_original_text --num_jobs {n_jobs} "
-            + f"--audio_directory {wavs_directory_path} {txt_directory_path} english_us_arpa english_us_arpa {text_grid_directory_path}"
-        )
-
-        metadata_df.loc[metadata_df["path_to_wav"].str.startswith(directory), "text"] = process_text_grid_files(
-            dataset_path=input_path,
-            metadata=processing_files,
-            comma_duration=comma_duration,
-            period_duration=period_duration,
-            n_jobs=n_jobs,
-        )
-
-        os.system(f"rm -rf {txt_directory_path} {text_grid_directory_path}")
-
-        progress_bar.update(len(processing_files))
+    # Temporary directories are removed in the background while MFA aligns the next directory
+    with ThreadPoolExecutor(max_workers=1) as cleanup_executor:
+        for directory, directory_index in directories_to_process.items():
+            processing_files = metadata_df.loc[directory_index]
+            save_texts_to_txt(dataset_path=input_path, metadata=processing_files, n_jobs=n_jobs)
+
+            wavs_directory_path = os.path.join(input_path, directory)
+            txt_directory_path = wavs_directory_path.replace("wavs", "txts")
+            text_grid_directory_path = wavs_directory_path.replace("wavs", "text_grids")
+
+            subprocess.run(
+                [
+                    "mfa",
+                    "align",
+                    "--clean",
+                    "--single_speaker",
+                    "--include_original_text",
+                    "--num_jobs",
+                    str(n_jobs),
+                    "--audio_directory",
+                    wavs_directory_path,
+                    txt_directory_path,
+                    "english_us_arpa",
+                    "english_us_arpa",
+                    text_grid_directory_path,
+                ],
+                check=False,
+            )
+
+            metadata_df.loc[directory_index, "text"] = process_text_grid_files(
+                dataset_path=input_path,
+                metadata=processing_files,
+                comma_duration=comma_duration,
+                period_duration=period_duration,
+                n_jobs=n_jobs,
+            )
+
+            # Directories can be nested, so they are first moved out of the way of the next directory's files
+            for temporary_directory_path in (txt_directory_path, text_grid_directory_path):
+                if os.path.exists(temporary_directory_path):
+                    trash_path = tempfile.mkdtemp(prefix=".mfa_cleanup_", dir=input_path)
+                    os.rename(temporary_directory_path, os.path.join(trash_path, "data"))
+                    cleanup_executor.submit(shutil.rmtree, trash_path, ignore_errors=True)
+
+            progress_bar.update(len(processing_files))
 
     metadata_df.drop(metadata_df[metadata_df["text"] == ""].index)
     metadata_df.to_csv(metadata_path, sep="|", index=False)
@@ -78,11 +106,13 @@ def process_text_grid_files(
     dataset_path: str, metadata: pd.DataFrame, n_jobs=-1, comma_duration: float = 0.15, period_duration: float = 0.3
 ) -> List[str | None]:
     dataset_path = dataset_path if dataset_path.endswith("/") else dataset_path + "/"
-    text_grid_paths = dataset_path + metadata["path_to_wav"].str.replace(".wav", ".TextGrid").str.replace(
-        "/wavs/", "/text_grids/"
-    )
+    text_grid_paths = [
+        dataset_path + path.replace(".wav", ".TextGrid").replace("/wavs/", "/text_grids/")
+        for path in metadata["path_to_wav"].values
+    ]
 
-    texts = Parallel(n_jobs=n_jobs)(
+    # Parsing a single .TextGrid is short, so tasks are sent to workers in batches
+    texts = Parallel(n_jobs=n_jobs, batch_size=64)(
         delayed(get_text_from_text_grid)(text_grid_path, comma_duration, period_duration)
         for text_grid_path in text_grid_paths
     )
@@ -94,7 +124,7 @@ def get_text_from_text_grid(
     text_grid_path: str, comma_duration: float = 0.15, period_duration: float = 0.3
 ) -> str | None:
     try:
-        text_grid = TextGrid.fromFile(text_grid_path)
+        word_intervals = read_word_intervals(text_grid_path)
     except FileNotFoundError:
         print(
             f"File {text_grid_path} was not found. It might be because corresponding .wav file "
@@ -103,52 +133,85 @@ def get_text_from_text_grid(
         )
         return None
 
-    word_tier = text_grid[0]
-
-    result_text = ""
-
-    for i, interval in enumerate(word_tier):
-        duration = interval.duration()  # Получаем длительность аннотации
-        label = interval.mark  # Получаем текст аннотации
+    result_parts = []
 
+    for i, (label, duration) in enumerate(word_intervals):
         if label == "":
             if i == 0:
                 continue
 
             if duration > period_duration:
-                result_text += ". "
+                result_parts.append(". ")
             elif duration > comma_duration:
-                result_text += ", "
+                result_parts.append(", ")
         else:
-            result_text += label + " "
+            result_parts.append(label + " ")
 
-    result_text = result_text.strip()
+    result_text = "".join(result_parts).strip()
     result_text += "."
 
-    result_text = re.sub(r"[,.]{2,}", ".", result_text)  # Multiple dots and periods into one period
-    result_text = re.sub(r"\s{2,}", " ", result_text)  # Multiple spaces into one space
+    result_text = MULTIPLE_PUNCTUATION_REGEX.sub(".", result_text)  # Multiple dots and periods into one period
+    result_text = MULTIPLE_SPACES_REGEX.sub(" ", result_text)  # Multiple spaces into one space
     result_text = result_text.replace(" .", ".")
     result_text = result_text.replace(" ,", ",")
 
     return result_text
 
 
+def read_word_intervals(text_grid_path: str, round_digits: int = 5) -> List[Tuple[str, float]]:
+    """
+    Read the words tier of a long-format .TextGrid file written by MFA.
+
+    Only the first tier is parsed, so the phones tier and the object tree of the textgrid library are skipped.
+    Times are rounded the same way textgrid does it.
+
+    Args:
+        text_grid_path (str): Path to the .TextGrid file.
+        round_digits (int): Number of digits the interval boundaries are rounded to.
+
+    Returns:
+        List[Tuple[str, float]]: (mark, duration) pairs of the words tier intervals.
+    """
+    with open(text_grid_path, "r", encoding="UTF-8") as f:
+        words_tier = f.read().split("item [2]:", 1)[0]
+
+    return [
+        (mark.replace('""', '"'), round(float(xmax), round_digits) - round(float(xmin), round_digits))
+        for xmin, xmax, mark in TEXT_GRID_INTERVAL_REGEX.findall(words_tier)
+    ]
+
+
 def save_texts_to_txt(dataset_path: str, metadata: pd.DataFrame, n_jobs=-1) -> None:
     texts = metadata["text"].str.replace("-", " ")
     dataset_path = dataset_path if dataset_path.endswith("/") else dataset_path + "/"
-    paths = dataset_path + metadata["path_to_wav"].str.replace(".wav", ".txt").str.replace("/wavs/", "/txts/")
-    Parallel(n_jobs=n_jobs)(delayed(save_text)(save_path, text) for save_path, text in zip(paths, texts))
+    paths = [
+        dataset_path + path.replace(".wav", ".txt").replace("/wavs/", "/txts/")
+        for path in metadata["path_to_wav"].values
+    ]
 
+    for directory in {os.path.dirname(path) for path in paths}:
+        os.makedirs(directory, exist_ok=True)
 
-def save_text(save_path: str, text: str) -> None:
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    # Each write is only a few hundred bytes, so threads are used instead of paying joblib's per-task overhead
+    with ThreadPoolExecutor(max_workers=normalize_n_jobs(n_jobs)) as executor:
+        list(executor.map(save_text, paths, texts))
 
+
+def save_text(save_path: str, text: str) -> None:
     with open(save_path, "w", encoding="UTF-8") as f:
         f.write(text)
 
 
-def get_list_of_directories(paths_to_wavs: pd.Series) -> pd.Series:
-    return paths_to_wavs.str.rsplit("/", n=1).str[0].unique()
+def normalize_n_jobs(n_jobs: int) -> int:
+    # Same semantics as joblib: -1 means all CPUs, -2 all but one and so on
+    if n_jobs < 0:
+        n_jobs = cpu_count() + 1 + n_jobs
+
+    return max(n_jobs, 1)
+
+
+def get_directories(paths_to_wavs: pd.Series) -> pd.Series:
+    return paths_to_wavs.str.rsplit("/", n=1).str[0]
 
 
 if __name__ == "__main__":
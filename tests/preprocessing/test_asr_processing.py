@@ -0,0 +1,40 @@
+import jiwer
+import pytest
+from jiwer import process_characters
+
+pytest.importorskip("pytriton")
+
+from src.preprocessing.asr_processing import get_error_rates
+
+PAIRS = [
+    ("hello world", "hello world"),
+    ("the cat sat", "the bat sat on"),
+    ("hello world", "hello big world"),  # Insertion only
+    ("hello big world", "hello world"),  # Deletion only
+    ("hello world", ""),  # Empty hypothesis
+    ("hello  world   again", "hello world again"),  # Multiple spaces in reference
+    ("a b c d", "d c b a"),
+]
+
+
+@pytest.mark.parametrize("reference, hypothesis", PAIRS)
+def test_get_error_rates_matches_jiwer(reference, hypothesis):
+    assert get_error_rates([reference], [hypothesis]) == pytest.approx([jiwer.wer(reference, hypothesis)])
+    assert get_error_rates([reference], [hypothesis], process_characters) == pytest.approx(
+        [jiwer.cer(reference, hypothesis)]
+    )
+
+
+def test_get_error_rates_whole_column():
+    references, hypotheses = zip(*PAIRS)
+
+    assert get_error_rates(list(references), list(hypotheses)) == pytest.approx(
+        [jiwer.wer(reference, hypothesis) for reference, hypothesis in PAIRS]
+    )
+    assert get_error_rates(list(references), list(hypotheses), process_characters) == pytest.approx(
+        [jiwer.cer(reference, hypothesis) for reference, hypothesis in PAIRS]
+    )
+
+
+def test_get_error_rates_empty():
+    assert get_error_rates([], []) == []
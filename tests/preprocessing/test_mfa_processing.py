@@ -0,0 +1,87 @@
+import pytest
+
+from src.preprocessing import mfa_processing
+from src.preprocessing.mfa_processing import get_text_from_text_grid, normalize_n_jobs, read_word_intervals
+
+
+def make_text_grid(words):
+    # Long-format .TextGrid as written by MFA: a words tier followed by a phones tier
+    xmax = words[-1][2]
+
+    def tier(index, name, intervals):
+        lines = [
+            f"    item [{index}]:",
+            '        class = "IntervalTier"',
+            f'        name = "{name}"',
+            "        xmin = 0",
+            f"        xmax = {xmax}",
+            f"        intervals: size = {len(intervals)}",
+        ]
+        for i, (mark, start, end) in enumerate(intervals, start=1):
+            lines += [
+                f"        intervals [{i}]:",
+                f"            xmin = {start}",
+                f"            xmax = {end}",
+                f'            text = "{mark}"',
+            ]
+        return lines
+
+    lines = [
+        'File type = "ooTextFile"',
+        'Object class = "TextGrid"',
+        "",
+        "xmin = 0",
+        f"xmax = {xmax}",
+        "tiers? <exists>",
+        "size = 2",
+        "item []:",
+    ]
+    lines += tier(1, "words", words)
+    lines += tier(2, "phones", [("AH0" if mark else "", start, end) for mark, start, end in words])
+
+    return "\n".join(lines) + "\n"
+
+
+@pytest.mark.parametrize(
+    "words, expected_result",
+    [
+        ([("hello", 0, 0.5), ("world", 0.5, 1.0)], "hello world."),
+        ([("", 0, 0.5), ("hello", 0.5, 1.0), ("world", 1.0, 1.5)], "hello world."),
+        ([("hello", 0, 0.5), ("", 0.5, 0.6), ("world", 0.6, 1.0)], "hello world."),
+        ([("hello", 0, 0.5), ("", 0.5, 0.7), ("world", 0.7, 1.0)], "hello, world."),
+        ([("hello", 0, 0.5), ("", 0.5, 1.0), ("world", 1.0, 1.5)], "hello. world."),
+        ([("hello", 0, 0.5), ("world", 0.5, 1.0), ("", 1.0, 1.5)], "hello world."),
+        ([("hello", 0, 0.5), ("world", 0.5, 1.0), ("", 1.0, 1.2)], "hello world."),
+        ([("don't", 0, 0.5), ("stop", 0.5, 1.0)], "don't stop."),
+    ],
+)
+def test_get_text_from_text_grid(tmp_path, words, expected_result):
+    text_grid_path = tmp_path / "sample.TextGrid"
+    text_grid_path.write_text(make_text_grid(words), encoding="UTF-8")
+
+    assert get_text_from_text_grid(str(text_grid_path)) == expected_result
+
+
+def test_get_text_from_text_grid_custom_durations(tmp_path):
+    text_grid_path = tmp_path / "sample.TextGrid"
+    text_grid_path.write_text(make_text_grid([("hello", 0, 0.5), ("", 0.5, 0.7), ("world", 0.7, 1.0)]))
+
+    assert get_text_from_text_grid(str(text_grid_path), comma_duration=0.05, period_duration=0.1) == "hello. world."
+
+
+def test_get_text_from_text_grid_missing_file(tmp_path):
+    assert get_text_from_text_grid(str(tmp_path / "missing.TextGrid")) is None
+
+
+def test_read_word_intervals_reads_only_words_tier(tmp_path):
+    text_grid_path = tmp_path / "sample.TextGrid"
+    text_grid_path.write_text(make_text_grid([("", 0, 0.25), ('say ""hi""', 0.25, 1.0)]))
+
+    assert read_word_intervals(str(text_grid_path)) == [("", 0.25), ('say "hi"', 0.75)]
+
+
+@pytest.mark.parametrize("n_jobs, expected", [(-1, 8), (-2, 7), (-8, 1), (-100, 1), (0, 1), (1, 1), (4, 4)])
+def test_normalize_n_jobs(monkeypatch, n_jobs, expected):
+    monkeypatch.setattr(mfa_processing, "cpu_count", lambda: 8)
+
+    assert normalize_n_jobs(n_jobs) == expected
@@ -23,7 +23,7 @@ class TritonPythonModel:
 
             input_samples = torch.from_numpy(input_samples).to(self.device)
 
-            with torch.inference_mode() and torch.no_grad():
+            with torch.inference_mode():
                 result = self.enhancer(input_samples)
 
             response = pb_utils.InferenceResponse(
@@ -7,6 +7,11 @@ from torchaudio.transforms import MelSpectrogram
 class TritonPythonModel:
     def initialize(self, args):
         self.sample_rate = 44100
+        self.device = f"cuda:{args['model_instance_device_id']}"
+        # Fade windows only depend on the chunking parameters, so they are built once per combination
+        self._fade_windows = {}
+        # Mel filterbanks are built once per sample rate and device instead of on every offset computation
+        self._mel_fns = {}
 
     def execute(self, requests):
         responses = []
@@ -17,7 +22,7 @@ class TritonPythonModel:
             chunk_duration_s = pb_utils.get_input_tensor_by_name(request, "CHUNK_DURATION_S").as_numpy()[0]
             chunk_overlap_s = pb_utils.get_input_tensor_by_name(request, "CHUNK_OVERLAP_S").as_numpy()[0]
 
-            audio_chunks = torch.tensor(audio_chunks)
+            audio_chunks = torch.from_numpy(audio_chunks).to(self.device)
             chunk_length = int(self.sample_rate * chunk_duration_s)
             overlap_length = int(self.sample_rate * chunk_overlap_s)
             hop_length = chunk_length - overlap_length
@@ -26,7 +31,7 @@ class TritonPythonModel:
 
             response = pb_utils.InferenceResponse(
                 output_tensors=[
-                    pb_utils.Tensor("OUTPUT_AUDIO", audio.numpy()),
+                    pb_utils.Tensor("OUTPUT_AUDIO", audio.cpu().numpy()),
                 ]
             )
             responses.append(response)
@@ -34,78 +39,99 @@ class TritonPythonModel:
         return responses
 
     def _merge_chunks(self, chunks, chunk_length, hop_length, sr=44100, length=None):
-        signal_length = (len(chunks) - 1) * hop_length + chunk_length
+        n_chunks = len(chunks)
+        signal_length = (n_chunks - 1) * hop_length + chunk_length
         overlap_length = chunk_length - hop_length
-        signal = torch.zeros(signal_length, device=chunks[0].device)
+        device = chunks.device
 
-        fadein = torch.linspace(0, 1, overlap_length, device=chunks[0].device)
-        fadein = torch.cat([fadein, torch.ones(hop_length, device=chunks[0].device)])
-        fadeout = torch.linspace(1, 0, overlap_length, device=chunks[0].device)
-        fadeout = torch.cat([torch.ones(hop_length, device=chunks[0].device), fadeout])
+        offsets = self._compute_offsets(chunks, overlap_length, sr=sr)
 
-        for i, chunk in enumerate(chunks):
-            start = i * hop_length
-            end = start + chunk_length
+        if chunks.shape[1] < chunk_length:
+            chunks = pad(chunks, (0, chunk_length - chunks.shape[1]))
 
-            if len(chunk) < chunk_length:
-                chunk = pad(chunk, (0, chunk_length - len(chunk)))
+        fadein, fadeout = self._get_fade_windows(overlap_length, hop_length, device)
+        windows = (fadein * fadeout).repeat(n_chunks, 1)
+        windows[-1] = fadein
+        windows[0] = fadeout
 
-            if i > 0:
-                pre_region = chunks[i - 1][-overlap_length:]
-                cur_region = chunk[:overlap_length]
-                offset = self._compute_offset(pre_region, cur_region, sr=sr)
-                start -= offset
-                end -= offset
+        # All chunks are overlap-added in one op. The signal is padded by a chunk on both sides,
+        # so shifted chunks never fall outside of it
+        starts = torch.arange(n_chunks, device=device) * hop_length - offsets + chunk_length
+        positions = starts[:, None] + torch.arange(chunk_length, device=device)
 
-            if i == 0:
-                chunk = chunk * fadeout
-            elif i == len(chunks) - 1:
-                chunk = chunk * fadein
-            else:
-                chunk = chunk * fadein * fadeout
-
-            signal[start:end] += chunk[: len(signal[start:end])]
+        signal = torch.zeros(signal_length + 2 * chunk_length, device=device)
+        signal.index_add_(0, positions.flatten(), (chunks * windows).flatten())
+        signal = signal[chunk_length : chunk_length + signal_length]
 
         signal = signal[:length]
 
         return signal
 
+    def _compute_offsets(self, chunks, overlap_length, sr=44100):
+        offsets = torch.zeros(len(chunks), dtype=torch.long, device=chunks.device)
+
+        if len(chunks) > 1:
+            # Overlap regions of all adjacent chunk pairs are compared as one batch
+            offsets[1:] = self._compute_offset(chunks[:-1, -overlap_length:], chunks[1:, :overlap_length], sr=sr)
+
+        return offsets
+
+    def _get_fade_windows(self, overlap_length, hop_length, device):
+        key = (overlap_length, hop_length, device)
+
+        if key not in self._fade_windows:
+            fadein = torch.linspace(0, 1, overlap_length, device=device)
+            fadein = torch.cat([fadein, torch.ones(hop_length, device=device)])
+            fadeout = torch.linspace(1, 0, overlap_length, device=device)
+            fadeout = torch.cat([torch.ones(hop_length, device=device), fadeout])
+            self._fade_windows[key] = (fadein, fadeout)
+
+        return self._fade_windows[key]
+
     def _compute_offset(self, chunk1, chunk2, sr=44100):
         """
         Args:
-            chunk1: (T,)
-            chunk2: (T,)
+            chunk1: (B, T)
+            chunk2: (B, T)
         Returns:
-            offset: int, offset in samples such that chunk1 ~= chunk2.roll(-offset)
+            offset: (B,), offsets in samples such that chunk1 ~= chunk2.roll(-offset)
         """
         hop_length = sr // 200  # 5 ms resolution
-        win_length = hop_length * 4
-        n_fft = 2 ** int(win_length - 1).bit_length()
-
-        mel_fn = MelSpectrogram(
-            sample_rate=sr,
-            n_fft=n_fft,
-            win_length=win_length,
-            hop_length=hop_length,
-            n_mels=80,
-            f_min=0.0,
-            f_max=sr // 2,
-        )
+        mel_fn = self._get_mel_fn(sr, chunk1.device)
 
         spec1 = mel_fn(chunk1).log1p()
         spec2 = mel_fn(chunk2).log1p()
 
-        corr = self._compute_corr(spec1, spec2)  # (F, T)
-        corr = corr.mean(dim=0)  # (T,)
-
-        argmax = corr.argmax().item()
+        corr = self._compute_corr(spec1, spec2)  # (B, F, T)
+        corr = corr.mean(dim=1)  # (B, T)
 
-        if argmax > len(corr) // 2:
-            argmax -= len(corr)
+        argmax = corr.argmax(dim=-1)
+        argmax = torch.where(argmax > corr.shape[-1] // 2, argmax - corr.shape[-1], argmax)
 
         offset = -argmax * hop_length
 
         return offset
 
+    def _get_mel_fn(self, sr, device):
+        key = (sr, device)
+
+        if key not in self._mel_fns:
+            hop_length = sr // 200  # 5 ms resolution
+            win_length = hop_length * 4
+            n_fft = 2 ** int(win_length - 1).bit_length()
+
+            self._mel_fns[key] = MelSpectrogram(
+                sample_rate=sr,
+                n_fft=n_fft,
+                win_length=win_length,
+                hop_length=hop_length,
+                n_mels=80,
+                f_min=0.0,
+                f_max=sr // 2,
+            ).to(device)
+
+        return self._mel_fns[key]
+
     def _compute_corr(self, x, y):
-        return torch.fft.ifft(torch.fft.fft(x) * torch.fft.fft(y).conj()).abs()
+        # The spectrograms are real, so only the non-negative frequencies are needed
+        return torch.fft.irfft(torch.fft.rfft(x) * torch.fft.rfft(y).conj(), n=x.shape[-1]).abs()
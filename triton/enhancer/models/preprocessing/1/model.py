@@ -1,13 +1,16 @@
 import triton_python_backend_utils as pb_utils
 import numpy as np
 from torch.nn.functional import pad
-from torchaudio.functional import resample
+from torchaudio.transforms import Resample
 import torch
 
 
 class TritonPythonModel:
     def initialize(self, args):
         self.sample_rate = 44100
+        self.device = f"cuda:{args['model_instance_device_id']}"
+        # Building the resampling kernel is expensive, so one transform is kept per input sample rate
+        self._resamplers = {}
 
     def execute(self, requests):
         responses = []
@@ -18,17 +21,9 @@ class TritonPythonModel:
             chunk_duration_s = pb_utils.get_input_tensor_by_name(request, "CHUNK_DURATION_S").as_numpy()[0]
             chunk_overlap_s = pb_utils.get_input_tensor_by_name(request, "CHUNK_OVERLAP_S").as_numpy()[0]
 
-            input_audio = torch.Tensor(input_audio)
+            input_audio = torch.from_numpy(input_audio).to(self.device)
 
-            audio = resample(
-                input_audio,
-                orig_freq=sr,
-                new_freq=self.sample_rate,
-                lowpass_filter_width=64,
-                rolloff=0.9475937167399596,
-                resampling_method="sinc_interp_kaiser",
-                beta=14.769656459379492,
-            )
+            audio = self._get_resampler(int(sr))(input_audio)
 
             audio_length = audio.shape[0]
 
@@ -36,19 +31,34 @@ class TritonPythonModel:
             overlap_length = int(self.sample_rate * chunk_overlap_s)
             hop_length = chunk_length - overlap_length
 
-            chunks = [audio[i : i + chunk_length] for i in range(0, audio_length, hop_length)]
-            input_chunks = torch.stack([pad(chunk, (0, chunk_length - len(chunk))) for chunk in chunks], dim=0)
+            # The audio is padded so that the last chunk starting before its end is complete,
+            # then all chunks are taken as a strided view instead of being sliced one by one
+            n_chunks = (audio_length + hop_length - 1) // hop_length
+            audio = pad(audio, (0, (n_chunks - 1) * hop_length + chunk_length - audio_length))
+            input_chunks = audio.unfold(0, chunk_length, hop_length)
 
-            abs_max = input_chunks.abs().max(dim=1, keepdim=True).values
-            abs_max[abs_max == 0] = 10e-7
+            abs_max = input_chunks.abs().amax(dim=1, keepdim=True).clamp_min_(10e-7)
             input_chunks = input_chunks / abs_max
 
             response = pb_utils.InferenceResponse(
                 output_tensors=[
-                    pb_utils.Tensor("BATCHED_SAMPLES", input_chunks.numpy()),
+                    pb_utils.Tensor("BATCHED_SAMPLES", input_chunks.cpu().numpy()),
                     pb_utils.Tensor("AUDIO_LENGTH", np.array(audio_length, dtype=np.int64).reshape((1,))),
                 ]
             )
             responses.append(response)
 
         return responses
+
+    def _get_resampler(self, sr):
+        if sr not in self._resamplers:
+            self._resamplers[sr] = Resample(
+                orig_freq=sr,
+                new_freq=self.sample_rate,
+                lowpass_filter_width=64,
+                rolloff=0.9475937167399596,
+                resampling_method="sinc_interp_kaiser",
+                beta=14.769656459379492,
+            ).to(self.device)
+
+        return self._resamplers[sr]